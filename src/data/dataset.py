@@ -2,6 +2,26 @@ import os
 
 import tensorflow as tf
 
+def load_resized_image(image_file, img_size, decode_ratio):
+    # Shared with data/make_tfrecords.py, so TFRecord and JPEG input give identical pixels.
+    # Read file into tensor of type string.
+    image_string = tf.read_file(image_file)
+    # Decodes file into jpg of type uint8 (range [0, 255]).
+    # TF's JPEG codec is libjpeg-turbo; the fast integer IDCT is its quickest SIMD path
+    # and the precision loss is negligible once the image is resized.
+    # A decode ratio > 1 downscales in the DCT domain, which is much cheaper than
+    # decoding at full resolution only for the resize to throw the detail away.
+    image = tf.image.decode_jpeg(image_string, channels=3, ratio=decode_ratio, dct_method='INTEGER_FAST')
+    # Resize with bicubic interpolation, making sure that corner pixel values
+    # are preserved.
+    image = tf.image.resize_images(image, size=[img_size, img_size],
+                                   method=tf.image.ResizeMethod.BICUBIC, align_corners=True)
+    # Keep images as uint8 (range [0, 255]) so batches copied to the GPU are 4x smaller
+    # than float32; the model converts them to [-1, 1] on device (see CycleGANModel.set_input).
+    # Saturate since bicubic interpolation can overshoot the input range.
+    image = tf.saturate_cast(tf.round(image), tf.uint8)
+    return image
+
 class Dataset(object):
     """
     Fully optimised tf.data loader.
@@ -16,46 +36,57 @@ class Dataset(object):
             self.trainB_path = os.path.join(self.opt.data_dir, 'trainB')
             self.trainA_size = len(os.listdir(self.trainA_path))
             self.trainB_size = len(os.listdir(self.trainB_path))
-            dataA, dataB = self.load_train_data()
+            self.data = self.load_train_data()
         else:
             self.testA_path = os.path.join(self.opt.data_dir, 'testA')
             self.testB_path = os.path.join(self.opt.data_dir, 'testB')
             self.testA_size = len(os.listdir(self.testA_path))
             self.testB_size = len(os.listdir(self.testB_path))
-            dataA, dataB = self.load_test_data()
-        self.data = {"A": dataA, "B": dataB}
+            self.data = self.load_test_data()
 
     def load_train_data(self):
-        # Create Dataset from folder of string filenames.
-        train_datasetA = tf.data.Dataset.list_files(self.trainA_path + os.sep + '*.jpg', shuffle=False)
-        train_datasetB = tf.data.Dataset.list_files(self.trainB_path + os.sep + '*.jpg', shuffle=False)
+        if self.opt.use_tfrecords:
+            # Read already resized images, written by data/make_tfrecords.py.
+            train_datasetA = self.load_tfrecords('trainA')
+            train_datasetB = self.load_tfrecords('trainB')
+        else:
+            # Create Dataset from folder of string filenames.
+            train_datasetA = tf.data.Dataset.list_files(self.trainA_path + os.sep + '*.jpg', shuffle=False)
+            train_datasetB = tf.data.Dataset.list_files(self.trainB_path + os.sep + '*.jpg', shuffle=False)
+            # Reads and decodes num_threads files concurrently. Sloppy ordering lets a slow
+            # file read not block the others, the images are shuffled after caching anyway.
+            train_datasetA = train_datasetA.apply(tf.contrib.data.parallel_interleave(self.load_image_dataset,
+                                                                                      cycle_length=self.opt.num_threads,
+                                                                                      sloppy=True))
+            train_datasetB = train_datasetB.apply(tf.contrib.data.parallel_interleave(self.load_image_dataset,
+                                                                                      cycle_length=self.opt.num_threads,
+                                                                                      sloppy=True))
+        # Cache the decoded and resized images so JPEGs are only decoded in the first epoch.
+        # Must come before the shuffle, otherwise every epoch would replay the same order.
+        train_datasetA = train_datasetA.cache(self.get_cache_file('trainA'))
+        train_datasetB = train_datasetB.cache(self.get_cache_file('trainB'))
         # Infinitely loop the dataset, shuffling once per epoch (in memory).
-        # Safe to do since the dataset pipeline is currently string filenames.
         # Fused operation is faster than separated shuffle and repeat.
         train_datasetA = train_datasetA.apply(tf.contrib.data.shuffle_and_repeat(buffer_size=self.trainA_size))
         train_datasetB = train_datasetB.apply(tf.contrib.data.shuffle_and_repeat(buffer_size=self.trainB_size))
-        # Decodes filenames into jpegs, then stacks them into batches.
+        # Stacks images into batches.
         # Throwing away the remainder allows the pipeline to report a fixed sized
         # batch size, aiding in model definition downstream.
-        train_datasetA = train_datasetA.apply(tf.contrib.data.map_and_batch(lambda x: self.load_image(x),
-                                                                            batch_size=self.opt.batch_size,
-                                                                            num_parallel_calls=self.opt.num_threads,
-                                                                            drop_remainder=True))
-        train_datasetB = train_datasetB.apply(tf.contrib.data.map_and_batch(lambda x: self.load_image(x),
-                                                                            batch_size=self.opt.batch_size,
-                                                                            num_parallel_calls=self.opt.num_threads,
-                                                                            drop_remainder=True))
-        # Queue up a number of batches on CPU side:
-        train_datasetA = train_datasetA.prefetch(buffer_size=self.opt.num_threads)
-        train_datasetB = train_datasetB.prefetch(buffer_size=self.opt.num_threads)
-        # Queue up batches asynchronously onto the GPU.
-        # As long as there is a pool of batches CPU side a GPU prefetch of 1 is fine.
+        train_datasetA = train_datasetA.batch(self.opt.batch_size, drop_remainder=True)
+        train_datasetB = train_datasetB.batch(self.opt.batch_size, drop_remainder=True)
+        # Pair up A and B batches so each training step needs a single iterator call,
+        # and a single prefetch buffer overlaps the whole pipeline with training.
+        train_dataset = tf.data.Dataset.zip((train_datasetA, train_datasetB))
+        # Queue up batches on CPU side, letting the runtime size the buffer:
+        train_dataset = train_dataset.prefetch(buffer_size=tf.contrib.data.AUTOTUNE)
+        # Queue up batches asynchronously onto the GPU. This must be the final transformation.
+        # A GPU buffer of 2 lets the copy of the next batch overlap the current step even
+        # when a batch is consumed right as it lands; batches are uint8 so this is cheap.
         # If no GPU exists gpu_id = -1:
         if self.opt.gpu_id != -1:
-            train_datasetA = train_datasetA.apply(tf.contrib.data.prefetch_to_device(self.gpu_id, buffer_size=1))
-            train_datasetB = train_datasetB.apply(tf.contrib.data.prefetch_to_device(self.gpu_id, buffer_size=1))
-        # Create a tf.data.Iterator from each Dataset:
-        return iter(train_datasetA), iter(train_datasetB)
+            train_dataset = train_dataset.apply(tf.contrib.data.prefetch_to_device(self.gpu_id, buffer_size=2))
+        # Create a tf.data.Iterator from the Dataset:
+        return iter(train_dataset)
 
     def load_test_data(self):
         test_datasetA = tf.data.Dataset.list_files(self.testA_path + os.sep + '*.jpg', shuffle=False)
@@ -68,43 +99,67 @@ class Dataset(object):
                                                                           batch_size=1,
                                                                           num_parallel_calls=self.opt.num_threads,
                                                                           drop_remainder=False))
-        test_datasetA = test_datasetA.prefetch(buffer_size=self.opt.num_threads)
-        test_datasetB = test_datasetB.prefetch(buffer_size=self.opt.num_threads)
+        test_dataset = tf.data.Dataset.zip((test_datasetA, test_datasetB))
+        test_dataset = test_dataset.prefetch(buffer_size=tf.contrib.data.AUTOTUNE)
         if self.opt.gpu_id != -1:
-            test_datasetA = test_datasetA.apply(tf.contrib.data.prefetch_to_device(self.gpu_id, buffer_size=1))
-            test_datasetB = test_datasetB.apply(tf.contrib.data.prefetch_to_device(self.gpu_id, buffer_size=1))
-        return iter(test_datasetA), iter(test_datasetB)
+            test_dataset = test_dataset.apply(tf.contrib.data.prefetch_to_device(self.gpu_id, buffer_size=1))
+        return iter(test_dataset)
 
-    def load_image(self, image_file):
-        # Read file into tensor of type string.
-        image_string = tf.read_file(image_file)
-        # Decodes file into jpg of type uint8 (range [0, 255]).
-        image = tf.image.decode_jpeg(image_string, channels=3)
-        # Convert to floating point with 32 bits (range [0, 1]).
-        image = tf.image.convert_image_dtype(image, tf.float32)
-        # Resize with bicubic interpolation, making sure that corner pixel values
-        # are preserved.
-        image = tf.image.resize_images(image, size=[self.opt.img_size, self.opt.img_size],
-                                       method=tf.image.ResizeMethod.BICUBIC, align_corners=True)
-        # Transform image to [-1, 1] from [0, 1].
-        image = (image - 0.5) * 2
+    def load_tfrecords(self, name):
+        # Shards are read concurrently, each record holds one raw uint8 image.
+        tfrecord_files = tf.data.Dataset.list_files(os.path.join(self.opt.data_dir, 'tfrecords', name + '-*.tfrecord'),
+                                                    shuffle=False)
+        dataset = tfrecord_files.apply(tf.contrib.data.parallel_interleave(tf.data.TFRecordDataset,
+                                                                           cycle_length=self.opt.num_threads,
+                                                                           sloppy=True))
+        dataset = dataset.map(self.parse_example, num_parallel_calls=self.opt.num_threads)
+        return dataset
+
+    def parse_example(self, serialized_example):
+        features = tf.parse_single_example(serialized_example, {'image': tf.FixedLenFeature([], tf.string)})
+        # Raw bytes to uint8 image (range [0, 255]), no JPEG decoding needed.
+        image = tf.decode_raw(features['image'], tf.uint8)
+        image = tf.reshape(image, shape=[self.opt.img_size, self.opt.img_size, 3])
         return image
 
+    def get_cache_file(self, name):
+        # An empty filename caches in memory.
+        if not self.opt.cache_dir:
+            return ''
+        if not os.path.exists(self.opt.cache_dir):
+            os.makedirs(self.opt.cache_dir)
+        # TF only checks that the cache file exists, so the name must identify the dataset,
+        # the input source and every option that changes the decoded images, otherwise stale
+        # images are reused. TFRecords get img_size and decode_ratio when they are written,
+        # make_tfrecords.py must be run with the same values.
+        dataset_name = os.path.basename(os.path.normpath(self.opt.data_dir))
+        source = 'tfrecords' if self.opt.use_tfrecords else 'jpeg'
+        return os.path.join(self.opt.cache_dir, '_'.join([dataset_name, name, source, str(self.opt.img_size),
+                                                          'ratio' + str(self.opt.decode_ratio)]))
+
+    def load_image_dataset(self, image_file):
+        # Wraps load_image in a single element Dataset for use with parallel_interleave.
+        return tf.data.Dataset.from_tensors(image_file).map(self.load_image)
+
+    def load_image(self, image_file):
+        return load_resized_image(image_file, self.opt.img_size, self.opt.decode_ratio)
+
     def save_images(self, test_images, image_index):
         image_paths = [os.path.join(self.opt.results_dir, 'generatedA', 'test' + str(image_index) + '_real.jpg'),
                         os.path.join(self.opt.results_dir, 'generatedA', 'test' + str(image_index) + '_fake.jpg'),
                         os.path.join(self.opt.results_dir, 'generatedB', 'test' + str(image_index) + '_real.jpg'),
                         os.path.join(self.opt.results_dir, 'generatedB', 'test' + str(image_index) + '_fake.jpg')]
-        for i in range(len(test_images)):
-            # Reshape to get rid of batch size dimension in the tensor.
-            image = tf.reshape(test_images[i], shape=[self.opt.img_size, self.opt.img_size, 3])
-            # Scale from [-1, 1] to [0, 1).
-            image = (image * 0.5) + 0.5
-            # Convert to uint8 (range [0, 255]), saturate to avoid possible under/overflow.
-            image = tf.image.convert_image_dtype(image, dtype=tf.uint8, saturate=True)
-            # JPEG encode image into string Tensor.
-            with tf.device("/cpu:0"):
-                image_string = tf.image.encode_jpeg(image, format='rgb', quality=95)
+        # Convert all images together, each tensor has a batch size of 1.
+        images = tf.concat(test_images, axis=0)
+        # Scale from [-1, 1] to [0, 1).
+        images = (images * 0.5) + 0.5
+        # Convert to uint8 (range [0, 255]), saturate to avoid possible under/overflow.
+        images = tf.image.convert_image_dtype(images, dtype=tf.uint8, saturate=True)
+        # JPEG encode images into string Tensors, copying them to the CPU once.
+        with tf.device("/cpu:0"):
+            images = tf.unstack(images)
+            for i in range(len(images)):
+                image_string = tf.image.encode_jpeg(images[i], format='rgb', quality=95)
                 tf.write_file(filename=image_paths[i], contents=image_string)
 
     def get_batches_per_epoch(self, opt):
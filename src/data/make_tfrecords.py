@@ -0,0 +1,39 @@
+import os
+import argparse
+
+import tensorflow as tf
+
+from dataset import load_resized_image
+
+tf.enable_eager_execution()
+"""
+This script converts the trainA and trainB JPEGs of a dataset into TFRecord shards of
+resized raw uint8 images, so training can skip JPEG decoding (train with --use_tfrecords).
+Shards are written to data_dir/tfrecords, and will overwrite existing shards.
+Run it as a script (python data/make_tfrecords.py), it reuses the image loading of dataset.py.
+"""
+def write_tfrecords(image_dir, output_prefix, num_shards, img_size, decode_ratio):
+    image_files = sorted(os.path.join(image_dir, f) for f in os.listdir(image_dir) if f.endswith('.jpg'))
+    for shard in range(num_shards):
+        shard_path = '{}-{:05d}-of-{:05d}.tfrecord'.format(output_prefix, shard, num_shards)
+        with tf.python_io.TFRecordWriter(shard_path) as writer:
+            for image_file in image_files[shard::num_shards]:
+                image = load_resized_image(image_file, img_size, decode_ratio)
+                feature = {'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[image.numpy().tobytes()]))}
+                example = tf.train.Example(features=tf.train.Features(feature=feature))
+                writer.write(example.SerializeToString())
+        print("Written ", shard_path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', required=True, help='path to directory where the dataset is stored, should have subfolders trainA, trainB')
+    parser.add_argument('--img_size', type=int, default=256, help='image size to resize to, must match --img_size used for training')
+    parser.add_argument('--decode_ratio', type=int, default=1, choices=[1, 2, 4, 8], help='downscale JPEGs by this factor while decoding; only use if source images are at least this many times larger than img_size')
+    parser.add_argument('--num_shards', type=int, default=8, help='number of TFRecord files to write per domain')
+    opt = parser.parse_args()
+
+    output_dir = os.path.join(opt.data_dir, 'tfrecords')
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    for name in ('trainA', 'trainB'):
+        write_tfrecords(os.path.join(opt.data_dir, name), os.path.join(output_dir, name), opt.num_shards, opt.img_size, opt.decode_ratio)
@@ -6,6 +6,10 @@ from models.losses import generator_loss, discriminator_loss, cycle_loss, identi
 from models.networks import Generator, Discriminator
 from utils.image_history_buffer import ImageHistoryBuffer
 
+# global_step used to be stepped by each of the 3 optimizer updates per batch. Keep counting
+# 3 per batch so step based schedules of existing checkpoints resume where they left off.
+GLOBAL_STEPS_PER_BATCH = 3
+
 class CycleGANModel(object):
     """
     CycleGAN model class, responsible for checkpointing and the forward and backward pass.
@@ -24,7 +28,22 @@ class CycleGANModel(object):
             self.learning_rate = tf.contrib.eager.Variable(opt.lr, dtype=tf.float32, name='learning_rate')
             self.disc_optim = tf.train.AdamOptimizer(self.learning_rate, beta1=opt.beta1)
             self.gen_optim = tf.train.AdamOptimizer(self.learning_rate, beta1=opt.beta1)
+            if opt.mixed_precision:
+                # Dynamic loss scaling stops small float16 activation gradients flushing to zero.
+                # Variables, and so Adam's slots, stay float32 (see networks.Float16ComputeMixin).
+                self.disc_loss_scale = tf.contrib.mixed_precision.ExponentialUpdateLossScaleManager(2**15, 2000)
+                self.gen_loss_scale = tf.contrib.mixed_precision.ExponentialUpdateLossScaleManager(2**15, 2000)
+                # Skips the update and lowers the loss scale if any gradient overflowed,
+                # otherwise raises the loss scale every 2000 finite steps.
+                self.disc_update_optim = tf.contrib.mixed_precision.LossScaleOptimizer(self.disc_optim, self.disc_loss_scale)
+                self.gen_update_optim = tf.contrib.mixed_precision.LossScaleOptimizer(self.gen_optim, self.gen_loss_scale)
+            else:
+                self.disc_loss_scale, self.gen_loss_scale = None, None
+                self.disc_update_optim, self.gen_update_optim = self.disc_optim, self.gen_optim
             self.global_step = tf.train.get_or_create_global_step()
+            # Gradients summed over the last accum_count batches, see optimize_parameters:
+            self.gen_gradients_sum, self.disc_gradients_sum = None, None
+            self.accum_count = 0
             # Initialize history buffers:
             self.discA_buffer = ImageHistoryBuffer(opt)
             self.discB_buffer = ImageHistoryBuffer(opt)
@@ -35,18 +54,29 @@ class CycleGANModel(object):
 
     def initialize_checkpoint(self):
         if self.opt.training:
-            self.checkpoint = tf.train.Checkpoint(discA=self.discA,
-                                                  discB=self.discB,
-                                                  genA2B=self.genA2B,
-                                                  genB2A=self.genB2A,
-                                                  disc_optim=self.disc_optim,
-                                                  gen_optim=self.gen_optim,
-                                                  learning_rate=self.learning_rate,
-                                                  global_step=self.global_step)
+            checkpointables = dict(discA=self.discA,
+                                   discB=self.discB,
+                                   genA2B=self.genA2B,
+                                   genB2A=self.genB2A,
+                                   disc_optim=self.disc_optim,
+                                   gen_optim=self.gen_optim,
+                                   learning_rate=self.learning_rate,
+                                   global_step=self.global_step)
+            if self.opt.mixed_precision:
+                # Resume with the loss scale that was reached, rather than backing off from 2**15 again.
+                checkpointables['disc_loss_scale'] = self.loss_scale_checkpoint(self.disc_loss_scale)
+                checkpointables['gen_loss_scale'] = self.loss_scale_checkpoint(self.gen_loss_scale)
+            self.checkpoint = tf.train.Checkpoint(**checkpointables)
         else:
             self.checkpoint = tf.train.Checkpoint(genA2B=self.genA2B,
                                                   genB2A=self.genB2A)
 
+    def loss_scale_checkpoint(self, loss_scale):
+        # Loss scale managers aren't checkpointable themselves, only their variables are.
+        return tf.train.Checkpoint(loss_scale=loss_scale._loss_scale,
+                                   good_steps=loss_scale._num_good_steps,
+                                   bad_steps=loss_scale._num_bad_steps)
+
     def restore_checkpoint(self):
         checkpoint_dir = os.path.join(self.opt.save_dir, 'checkpoints')
         latest_checkpoint = tf.train.latest_checkpoint(checkpoint_dir)
@@ -60,9 +90,15 @@ class CycleGANModel(object):
             print("Failed to restore checkpoint, initializing model.")
 
     def set_input(self, input):
-        # Get next batches:
-        self.dataA = input["A"].get_next()
-        self.dataB = input["B"].get_next()
+        # Get next pair of batches:
+        dataA, dataB = input.get_next()
+        self.dataA = self.normalize(dataA)
+        self.dataB = self.normalize(dataB)
+
+    def normalize(self, image_batch):
+        # Transform uint8 batch (range [0, 255]) to float32 (range [-1, 1]).
+        # Done here rather than in the input pipeline so the conversion runs on device.
+        return tf.cast(image_batch, tf.float32) * (1 / 127.5) - 1
 
     def forward(self):
         # Gen output shape: (batch_size, img_size, img_size, 3)
@@ -112,8 +148,13 @@ class CycleGANModel(object):
         else:
             id_lossA, id_lossB = 0, 0
 
-        self.genA2B_loss = generator_loss(self.discB(self.dataB), self.discB(self.fakeB), self.opt.gan_mode)
-        self.genB2A_loss = generator_loss(self.discA(self.dataA), self.discA(self.fakeA), self.opt.gan_mode)
+        # Only the relativistic loss needs D's output on real images, skip those passes otherwise.
+        if self.opt.gan_mode == 'rgan':
+            pred_realB, pred_realA = self.discB(self.dataB), self.discA(self.dataA)
+        else:
+            pred_realB, pred_realA = None, None
+        self.genA2B_loss = generator_loss(pred_realB, self.discB(self.fakeB), self.opt.gan_mode)
+        self.genB2A_loss = generator_loss(pred_realA, self.discA(self.fakeA), self.opt.gan_mode)
 
         self.cyc_lossA = cycle_loss(self.dataA, self.reconstructedA) * self.opt.cyc_lambda
         self.cyc_lossB = cycle_loss(self.dataB, self.reconstructedB) * self.opt.cyc_lambda
@@ -122,38 +163,57 @@ class CycleGANModel(object):
         return gen_loss
 
     def optimize_parameters(self):
-        for net in (self.discA, self.discB):
-            for layer in net.layers:
-                layer.trainable = False
-
-        with tf.GradientTape() as genTape:
-            genTape.watch([self.genA2B.variables, self.genB2A.variables])
-
+        # A single forward pass is shared by the generator and discriminator updates, as in
+        # the original CycleGAN. Each gradient is only taken w.r.t. its own networks' variables,
+        # and D only sees detached fakes, so the losses don't leak into each other's updates.
+        with tf.GradientTape(persistent=True) as tape:
+            tape.watch(self.genA2B.variables + self.genB2A.variables + self.discA.variables + self.discB.variables)
             self.forward()
             gen_loss = self.backward_G()
-
-        gen_variables = [self.genA2B.variables, self.genB2A.variables]
-        gen_gradients = genTape.gradient(gen_loss, gen_variables)
-        self.gen_optim.apply_gradients(list(zip(gen_gradients[0], gen_variables[0])) \
-                                     + list(zip(gen_gradients[1], gen_variables[1])),
-                                     global_step=self.global_step)
-
-        for net in (self.discA, self.discB):
-            for layer in net.layers:
-                layer.trainable = True
-
-        with tf.GradientTape(persistent=True) as discTape:
-            discTape.watch([self.discA.variables, self.discB.variables])
-            self.forward()
-            discA_loss = self.backward_discA(discTape)
-            discB_loss = self.backward_discB(discTape)
-
-        discA_gradients = discTape.gradient(discA_loss, self.discA.variables)
-        discB_gradients = discTape.gradient(discB_loss, self.discB.variables)
-        self.disc_optim.apply_gradients(zip(discA_gradients, self.discA.variables),
-                                      global_step=self.global_step)
-        self.disc_optim.apply_gradients(zip(discB_gradients, self.discB.variables),
-                                      global_step=self.global_step)
+            discA_loss = self.backward_discA(tape)
+            discB_loss = self.backward_discB(tape)
+
+        gen_variables = self.genA2B.variables + self.genB2A.variables
+        gen_gradients = self.compute_gradients(tape, gen_loss, gen_variables, self.gen_loss_scale)
+        discA_gradients = self.compute_gradients(tape, discA_loss, self.discA.variables, self.disc_loss_scale)
+        discB_gradients = self.compute_gradients(tape, discB_loss, self.discB.variables, self.disc_loss_scale)
+        del tape
+
+        disc_variables = self.discA.variables + self.discB.variables
+        disc_gradients = discA_gradients + discB_gradients
+        # global_step counts batches, whether or not they trigger an update.
+        self.global_step.assign_add(GLOBAL_STEPS_PER_BATCH)
+        if self.opt.accum_steps > 1:
+            # Sum gradients over accum_steps batches, then apply their mean as one update.
+            self.gen_gradients_sum = self.sum_gradients(self.gen_gradients_sum, gen_gradients)
+            self.disc_gradients_sum = self.sum_gradients(self.disc_gradients_sum, disc_gradients)
+            self.accum_count += 1
+            if self.accum_count < self.opt.accum_steps:
+                return
+            gen_gradients = [gradient / self.opt.accum_steps for gradient in self.gen_gradients_sum]
+            disc_gradients = [gradient / self.opt.accum_steps for gradient in self.disc_gradients_sum]
+            self.gen_gradients_sum, self.disc_gradients_sum = None, None
+            self.accum_count = 0
+
+        # LossScaleOptimizer iterates grads_and_vars twice, so they can't be a one-shot zip.
+        self.gen_update_optim.apply_gradients(list(zip(gen_gradients, gen_variables)))
+        # One update for both discriminators, this also steps Adam's shared beta powers
+        # once per update rather than twice.
+        self.disc_update_optim.apply_gradients(list(zip(disc_gradients, disc_variables)))
+
+    def sum_gradients(self, gradients_sum, gradients):
+        if gradients_sum is None:
+            return gradients
+        return [total + gradient for total, gradient in zip(gradients_sum, gradients)]
+
+    def compute_gradients(self, tape, loss, variables, loss_scale):
+        if loss_scale is None:
+            return tape.gradient(loss, variables)
+        # Backpropagate loss * loss_scale, then unscale the gradients. Both the scale and
+        # the gradients w.r.t. the float32 master weights are float32.
+        scale = loss_scale.get_loss_scale()
+        gradients = tape.gradient(loss, variables, output_gradients=scale)
+        return [gradient / scale for gradient in gradients]
 
     def save_model(self):
         checkpoint_prefix = os.path.join(self.opt.save_dir, 'checkpoints', 'ckpt')
@@ -170,7 +230,7 @@ class CycleGANModel(object):
         self.learning_rate.assign(new_lr)
 
     def _get_learning_rate(self, batches_per_epoch):
-        global_step = self.global_step.numpy() / 3 # /3 because there are 3 gradient updates per batch.
+        global_step = self.global_step.numpy() // GLOBAL_STEPS_PER_BATCH
         total_epochs = global_step // batches_per_epoch
         learning_rate_lambda = 1.0 - max(0, total_epochs - self.opt.niter) / float(self.opt.niter_decay + 1)
         return self.opt.lr * max(0, learning_rate_lambda)
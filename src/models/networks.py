@@ -4,43 +4,96 @@ import tensorflow as tf
 This file defines the CycleGAN generator and discriminator.
 Options are included for extra skips, instance norm, dropout, and resize conv instead of deconv
 """
+class Float16ComputeMixin(object):
+    """
+    Keeps a conv layer's variables in float32 but computes in the dtype of its inputs.
+    With mixed precision G and D feed float16 activations, so the kernel and bias are
+    cast to float16 for the conv only; gradients flow back through the cast to the
+    float32 master weights, which is what the optimizer updates.
+    """
+    def call(self, inputs):
+        if inputs.dtype == self.kernel.dtype:
+            return super(Float16ComputeMixin, self).call(inputs)
+        kernel, bias = self.kernel, self.bias
+        self.kernel = tf.cast(kernel, inputs.dtype)
+        if bias is not None:
+            self.bias = tf.cast(bias, inputs.dtype)
+        try:
+            return super(Float16ComputeMixin, self).call(inputs)
+        finally:
+            self.kernel, self.bias = kernel, bias
+
+
+class Conv2D(Float16ComputeMixin, tf.keras.layers.Conv2D):
+    pass
+
+
+class Conv2DTranspose(Float16ComputeMixin, tf.keras.layers.Conv2DTranspose):
+    pass
+
+
+def reflect_pad(x, pad, data_format):
+    # Reflection pads the spatial dimensions only.
+    if data_format == 'channels_first':
+        return tf.pad(x, [[0, 0], [0, 0], [pad, pad], [pad, pad]], 'REFLECT')
+    return tf.pad(x, [[0, 0], [pad, pad], [pad, pad], [0, 0]], 'REFLECT')
+
+def instance_norm(x, data_format):
+    return tf.contrib.layers.instance_norm(x, center=False, scale=False, epsilon=1e-05, trainable=False,
+                                           data_format='NCHW' if data_format == 'channels_first' else 'NHWC')
+
+def upsample(x, data_format):
+    # Nearest neighbour 2x upsampling. Keras' UpSampling2D transposes channels_first inputs
+    # to NHWC and back, so NCHW is upsampled by repeating each pixel with reshape and tile.
+    if data_format == 'channels_first':
+        _, c, h, w = x.shape.as_list()
+        x = tf.reshape(x, [-1, c, h, 1, w, 1])
+        x = tf.tile(x, [1, 1, 1, 2, 1, 2])
+        return tf.reshape(x, [-1, c, h * 2, w * 2])
+    _, h, w, _ = x.shape.as_list()
+    return tf.image.resize_nearest_neighbor(x, [h * 2, w * 2])
+
 class Encoder(tf.keras.Model):
 
     def __init__(self, opt):
         super(Encoder, self).__init__()
+        self.data_format = opt.data_format
         self.use_dropout = opt.use_dropout
         self.norm = opt.instance_norm
         self.training = opt.training
         if self.use_dropout:
             self.norm = False # We don't want to combine instance normalisation and dropout.
             self.dropout = tf.keras.layers.Dropout(opt.dropout_prob)
-        self.conv1 = tf.keras.layers.Conv2D(opt.ngf, kernel_size=7, strides=1,
-                                            kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale))
-        self.conv2 = tf.keras.layers.Conv2D(opt.ngf * 2, kernel_size=3, strides=2, padding='same',
-                                            kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale))
-        self.conv3 = tf.keras.layers.Conv2D(opt.ngf * 4, kernel_size=3, strides=2, padding='same',
-                                            kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale))
+        self.conv1 = Conv2D(opt.ngf, kernel_size=7, strides=1,
+                            kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale), dtype=tf.float32,
+                            data_format=opt.data_format)
+        self.conv2 = Conv2D(opt.ngf * 2, kernel_size=3, strides=2, padding='same',
+                            kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale), dtype=tf.float32,
+                            data_format=opt.data_format)
+        self.conv3 = Conv2D(opt.ngf * 4, kernel_size=3, strides=2, padding='same',
+                            kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale), dtype=tf.float32,
+                            data_format=opt.data_format)
 
     def call(self, inputs):
         # Reflection padding is used to reduce artifacts.
-        x = tf.pad(inputs, [[0, 0], [3, 3], [3, 3], [0, 0]], 'REFLECT')
+        x = reflect_pad(inputs, 3, self.data_format)
         x = self.conv1(x)
         if self.norm:
-            x = tf.contrib.layers.instance_norm(x, center=False, scale=False, epsilon=1e-05, trainable=False)
+            x = instance_norm(x, self.data_format)
         x = tf.nn.relu(x)
         if self.use_dropout:
             x = self.dropout(x, training=self.training)
 
         x = self.conv2(x)
         if self.norm:
-            x = tf.contrib.layers.instance_norm(x, center=False, scale=False, epsilon=1e-05, trainable=False)
+            x = instance_norm(x, self.data_format)
         x = tf.nn.relu(x)
         if self.use_dropout:
             x = self.dropout(x, training=self.training)
 
         x = self.conv3(x)
         if self.norm:
-            x = tf.contrib.layers.instance_norm(x, center=False, scale=False, epsilon=1e-05, trainable=False)
+            x = instance_norm(x, self.data_format)
         x = tf.nn.relu(x)
         if self.use_dropout:
             x = self.dropout(x, training=self.training)
@@ -51,30 +104,33 @@ class Residual(tf.keras.Model):
 
     def __init__(self, opt):
         super(Residual, self).__init__()
+        self.data_format = opt.data_format
         self.use_dropout = opt.use_dropout
         self.norm = opt.instance_norm
         self.training = opt.training
         if self.use_dropout:
             self.norm = False
             self.dropout = tf.keras.layers.Dropout(opt.dropout_prob)
-        self.conv1 = tf.keras.layers.Conv2D(opt.ngf * 4, kernel_size=3, strides=1,
-                                            kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale))
-        self.conv2 = tf.keras.layers.Conv2D(opt.ngf * 4, kernel_size=3, strides=1,
-                                            kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale))
+        self.conv1 = Conv2D(opt.ngf * 4, kernel_size=3, strides=1,
+                            kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale), dtype=tf.float32,
+                            data_format=opt.data_format)
+        self.conv2 = Conv2D(opt.ngf * 4, kernel_size=3, strides=1,
+                            kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale), dtype=tf.float32,
+                            data_format=opt.data_format)
 
     def call(self, inputs):
-        x = tf.pad(inputs, [[0, 0], [1, 1], [1, 1], [0, 0]], 'REFLECT')
+        x = reflect_pad(inputs, 1, self.data_format)
         x = self.conv1(x)
         if self.norm:
-            x = tf.contrib.layers.instance_norm(x, center=False, scale=False, epsilon=1e-05, trainable=False)
+            x = instance_norm(x, self.data_format)
         x = tf.nn.relu(x)
         if self.use_dropout:
             x = self.dropout(x, training=self.training)
 
-        x = tf.pad(x, [[0, 0], [1, 1], [1, 1], [0, 0]], 'REFLECT')
+        x = reflect_pad(x, 1, self.data_format)
         x = self.conv2(x)
         if self.norm:
-            x = tf.contrib.layers.instance_norm(x, center=False, scale=False, epsilon=1e-05, trainable=False)
+            x = instance_norm(x, self.data_format)
         if self.use_dropout:
             x = self.dropout(x, training=self.training)
 
@@ -86,6 +142,7 @@ class Decoder(tf.keras.Model):
 
     def __init__(self, opt):
         super(Decoder, self).__init__()
+        self.data_format = opt.data_format
         self.use_dropout = opt.use_dropout
         self.norm = opt.instance_norm
         self.training = opt.training
@@ -94,46 +151,51 @@ class Decoder(tf.keras.Model):
             self.norm = False
             self.dropout = tf.keras.layers.Dropout(opt.dropout_prob)
         if self.resize_conv:
-            # Nearest neighbour upsampling:
-            self.upsample = tf.keras.layers.UpSampling2D(size=(2, 2))
-            self.conv1 = tf.keras.layers.Conv2D(opt.ngf * 2, kernel_size=3, strides=1,
-                                                kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale))
-            self.conv2 = tf.keras.layers.Conv2D(opt.ngf, kernel_size=3, strides=1,
-                                                kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale))
+            # Nearest neighbour upsampling followed by a stride 1 conv, no checkerboard artifacts.
+            # Also faster than a stride 2 transposed conv, whose cuDNN kernels are slower.
+            self.conv1 = Conv2D(opt.ngf * 2, kernel_size=3, strides=1,
+                                kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale), dtype=tf.float32,
+                                data_format=opt.data_format)
+            self.conv2 = Conv2D(opt.ngf, kernel_size=3, strides=1,
+                                kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale), dtype=tf.float32,
+                                data_format=opt.data_format)
         else:
-            self.conv1 = tf.keras.layers.Conv2DTranspose(opt.ngf * 2, kernel_size=3, strides=2, padding='same',
-                                                kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale))
-            self.conv2 = tf.keras.layers.Conv2DTranspose(opt.ngf, kernel_size=3, strides=2, padding='same',
-                                                kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale))
-        self.conv3 = tf.keras.layers.Conv2D(3, kernel_size=7, strides=1,
-                                                kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale))
+            self.conv1 = Conv2DTranspose(opt.ngf * 2, kernel_size=3, strides=2, padding='same',
+                                         kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale), dtype=tf.float32,
+                                         data_format=opt.data_format)
+            self.conv2 = Conv2DTranspose(opt.ngf, kernel_size=3, strides=2, padding='same',
+                                         kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale), dtype=tf.float32,
+                                         data_format=opt.data_format)
+        self.conv3 = Conv2D(3, kernel_size=7, strides=1,
+                            kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale), dtype=tf.float32,
+                            data_format=opt.data_format)
 
     def call(self, inputs):
         x = inputs
         if self.resize_conv:
-            x = self.upsample(x)
-            x = tf.pad(x, [[0, 0], [1, 1], [1, 1], [0, 0]], 'REFLECT')
+            x = upsample(x, self.data_format)
+            x = reflect_pad(x, 1, self.data_format)
         x = self.conv1(x)
         if self.norm:
-            x = tf.contrib.layers.instance_norm(x, center=False, scale=False, epsilon=1e-05, trainable=False)
+            x = instance_norm(x, self.data_format)
         x = tf.nn.relu(x)
         if self.use_dropout:
             x = self.dropout(x, training=self.training)
 
         if self.resize_conv:
-            x = self.upsample(x)
-            x = tf.pad(x, [[0, 0], [1, 1], [1, 1], [0, 0]], 'REFLECT')
+            x = upsample(x, self.data_format)
+            x = reflect_pad(x, 1, self.data_format)
         x = self.conv2(x)
         if self.norm:
-            x = tf.contrib.layers.instance_norm(x, center=False, scale=False, epsilon=1e-05, trainable=False)
+            x = instance_norm(x, self.data_format)
         x = tf.nn.relu(x)
         if self.use_dropout:
             x = self.dropout(x, training=self.training)
 
-        x = tf.pad(x, [[0, 0], [3, 3], [3, 3], [0, 0]], 'REFLECT')
+        x = reflect_pad(x, 3, self.data_format)
         x = self.conv3(x)
         if self.norm:
-            x = tf.contrib.layers.instance_norm(x, center=False, scale=False, epsilon=1e-05, trainable=False)
+            x = instance_norm(x, self.data_format)
         x = tf.nn.tanh(x)
         if self.use_dropout:
             x = self.dropout(x, training=self.training)
@@ -145,6 +207,8 @@ class Generator(tf.keras.Model):
     def __init__(self, opt):
         super(Generator, self).__init__()
         self.img_size = opt.img_size
+        self.mixed_precision = opt.mixed_precision
+        self.data_format = opt.data_format
         # If true, adds skip connection from the end of the encoder to start of decoder:
         self.gen_skip = opt.gen_skip
         self.encoder = Encoder(opt)
@@ -169,6 +233,11 @@ class Generator(tf.keras.Model):
 
     @tf.contrib.eager.defun
     def call(self, inputs):
+        if self.mixed_precision:
+            inputs = tf.cast(inputs, tf.float16)
+        # Inputs and outputs are always NHWC, transpose once here rather than per layer.
+        if self.data_format == 'channels_first':
+            inputs = tf.transpose(inputs, [0, 3, 1, 2])
         inputs = self.encoder(inputs)
         if(self.img_size == 128):
             x = self.res1(inputs)
@@ -192,6 +261,10 @@ class Generator(tf.keras.Model):
             if(self.gen_skip):
                 x = tf.add(x, inputs)
         x = self.decoder(x)
+        if self.data_format == 'channels_first':
+            x = tf.transpose(x, [0, 2, 3, 1])
+        if self.mixed_precision:
+            x = tf.cast(x, tf.float32)
         return x
 
 
@@ -199,38 +272,54 @@ class Discriminator(tf.keras.Model):
 
     def __init__(self, opt):
         super(Discriminator, self).__init__()
+        self.data_format = opt.data_format
+        self.mixed_precision = opt.mixed_precision
         self.norm = opt.instance_norm
-        self.conv1 = tf.keras.layers.Conv2D(opt.ndf, kernel_size=4, strides=2, padding='same',
-                                            kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale))
-        self.conv2 = tf.keras.layers.Conv2D(opt.ndf * 2, kernel_size=4, strides=2, padding='same',
-                                            kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale))
-        self.conv3 = tf.keras.layers.Conv2D(opt.ndf * 4, kernel_size=4, strides=2, padding='same',
-                                            kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale))
-        self.conv4 = tf.keras.layers.Conv2D(opt.ndf * 8, kernel_size=4, strides=1, padding='same',
-                                            kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale))
-        self.conv5 = tf.keras.layers.Conv2D(1, kernel_size=4, strides=1, padding='same',
-                                            kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale))
+        self.conv1 = Conv2D(opt.ndf, kernel_size=4, strides=2, padding='same',
+                            kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale), dtype=tf.float32,
+                            data_format=opt.data_format)
+        self.conv2 = Conv2D(opt.ndf * 2, kernel_size=4, strides=2, padding='same',
+                            kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale), dtype=tf.float32,
+                            data_format=opt.data_format)
+        self.conv3 = Conv2D(opt.ndf * 4, kernel_size=4, strides=2, padding='same',
+                            kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale), dtype=tf.float32,
+                            data_format=opt.data_format)
+        self.conv4 = Conv2D(opt.ndf * 8, kernel_size=4, strides=1, padding='same',
+                            kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale), dtype=tf.float32,
+                            data_format=opt.data_format)
+        self.conv5 = Conv2D(1, kernel_size=4, strides=1, padding='same',
+                            kernel_initializer=tf.truncated_normal_initializer(stddev=opt.init_scale), dtype=tf.float32,
+                            data_format=opt.data_format)
         self.leaky = tf.keras.layers.LeakyReLU(0.2)
 
     @tf.contrib.eager.defun
     def call(self, inputs):
+        if self.mixed_precision:
+            inputs = tf.cast(inputs, tf.float16)
+        # Inputs and outputs are always NHWC, transpose once here rather than per layer.
+        if self.data_format == 'channels_first':
+            inputs = tf.transpose(inputs, [0, 3, 1, 2])
         x = self.conv1(inputs)
         x = self.leaky(x)
 
         x = self.conv2(x)
         if self.norm:
-            x = tf.contrib.layers.instance_norm(x, center=False, scale=False, epsilon=1e-05, trainable=False)
+            x = instance_norm(x, self.data_format)
         x = self.leaky(x)
 
         x = self.conv3(x)
         if self.norm:
-            x = tf.contrib.layers.instance_norm(x, center=False, scale=False, epsilon=1e-05, trainable=False)
+            x = instance_norm(x, self.data_format)
         x = self.leaky(x)
 
         x = self.conv4(x)
         if self.norm:
-            x = tf.contrib.layers.instance_norm(x, center=False, scale=False, epsilon=1e-05, trainable=False)
+            x = instance_norm(x, self.data_format)
         x = self.leaky(x)
 
         x = self.conv5(x)
+        if self.data_format == 'channels_first':
+            x = tf.transpose(x, [0, 2, 3, 1])
+        if self.mixed_precision:
+            x = tf.cast(x, tf.float32)
         return x
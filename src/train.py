@@ -5,7 +5,7 @@ import tensorflow as tf
 
 from utils.options import Options
 from data.dataset import Dataset
-from models.cyclegan import CycleGANModel
+from models.cyclegan import CycleGANModel, GLOBAL_STEPS_PER_BATCH
 
 tf.enable_eager_execution()
 """
@@ -28,9 +28,10 @@ if __name__ == "__main__":
         for epoch in range(1, opt.epochs):
             start = time.time()
             for train_step in range(batches_per_epoch):
-                # Record summaries every 100 train_steps, we multiply by 3 because there are 3 gradient updates per step.
+                # Record summaries every 100 train_steps, global_step counts GLOBAL_STEPS_PER_BATCH per step.
                 with summary_writer.as_default(), \
-                tf.contrib.summary.record_summaries_every_n_global_steps(opt.summary_freq * 3, global_step=global_step):
+                tf.contrib.summary.record_summaries_every_n_global_steps(opt.summary_freq * GLOBAL_STEPS_PER_BATCH,
+                                                                         global_step=global_step):
                     model.set_input(dataset.data)
                     model.optimize_parameters()
                     if opt.save_summaries:
@@ -46,12 +47,13 @@ if __name__ == "__main__":
                         tf.contrib.summary.image('A/reconstructed', model.reconstructedA)
                         tf.contrib.summary.image('B/generated', model.fakeB)
                         tf.contrib.summary.image('B/reconstructed', model.reconstructedB)
-                    print("Iteration complete")
+                if train_step % opt.summary_freq == 0:
+                    print("Training step: ", train_step)
             # Assign decayed learning rate:
             model.update_learning_rate(batches_per_epoch)
             # Checkpoint the model:
             if epoch % opt.save_epoch_freq == 0:
                 model.save_model()
-            print("Global Training Step: ", global_step.numpy() // 3)
+            print("Global Training Step: ", global_step.numpy() // GLOBAL_STEPS_PER_BATCH)
             print("Time taken for total epoch {} is {} sec\n".format(global_step.numpy() \
-                                            // (3 * batches_per_epoch), time.time()-start))
+                                            // (GLOBAL_STEPS_PER_BATCH * batches_per_epoch), time.time()-start))
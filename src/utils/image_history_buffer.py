@@ -1,7 +1,6 @@
 import random
 
 import tensorflow as tf
-import numpy as np
 
 class ImageHistoryBuffer(object):
     """History of generated images.
@@ -15,12 +14,21 @@ class ImageHistoryBuffer(object):
             incoming images.
 
     Attributes:
-        image_history_buffer: Numpy array of image batches used to calculate average loss.
+        image_history_buffer: Variable of generated images used to calculate average loss.
+            Kept on the same device as the generator output, so querying never copies
+            images to the host.
+        num_images: Number of images currently stored in the buffer.
     """
     def __init__(self, opt):
         self.max_buffer_size = opt.buffer_size
         self.batch_size = opt.batch_size
-        self.image_history_buffer = np.zeros((0, opt.img_size, opt.img_size, 3))
+        # The model is built outside the training device scope, so place the buffer explicitly
+        # on the device that runs G, otherwise it lands on the default device.
+        device = ("/gpu:" + str(opt.gpu_id)) if opt.gpu_id != -1 else "/cpu:0"
+        with tf.device(device):
+            self.image_history_buffer = tf.contrib.eager.Variable(tf.zeros([self.max_buffer_size, opt.img_size, opt.img_size, 3]),
+                                                                  trainable=False, name='image_history_buffer')
+        self.num_images = 0
         assert(self.batch_size >= 1)
 
     def query(self, image_batch):
@@ -28,45 +36,46 @@ class ImageHistoryBuffer(object):
             history buffer, then randomly replaces max(1, batch size / 2) images
             in the batch with images sampled from the buffer. If batch size is 1,
             then we flip a coin to decide if we return a random image from the
-            buffer or the original image. The conversion to numpy array is done
-            because Tensorflow's random shuffle doesn't work on the GPU.
+            buffer or the original image.
 
         Args:
-            image_batch: Tensor of shape=(batch_size, img_size/8, img_size/8, 1).
+            image_batch: Tensor of shape=(batch_size, img_size, img_size, 3).
 
         Returns:
             Tensor: Processed batch.
         """
-        image_batch = image_batch.numpy()
         self._add_to_image_history_buffer(image_batch)
         if self.batch_size > 1:
-            image_batch[:self.batch_size // 2] = self._get_from_image_history_buffer()
+            images_to_get = self.batch_size // 2
+            image_batch = tf.concat([self._get_from_image_history_buffer(), image_batch[images_to_get:]], axis=0)
         else:
             p = random.random()
             if p > 0.5:
-                random_image = self._get_from_image_history_buffer()
-                return tf.convert_to_tensor(random_image, dtype=tf.float32)
-        return tf.convert_to_tensor(image_batch, dtype=tf.float32)
+                return self._get_from_image_history_buffer()
+        return image_batch
 
     def _add_to_image_history_buffer(self, image_batch):
-        """Private method to add max(1, batch size / 2) images to buffer.
+        """Private method to add max(1, batch size / 2) images to buffer. Fills
+            the buffer in order, then once full overwrites random images.
 
         Args:
-            image_batch (ndarray): Incoming image batch.
+            image_batch (Tensor): Incoming image batch.
         """
         images_to_add = max(1, self.batch_size // 2)
 
-        if len(self.image_history_buffer) < self.max_buffer_size:
-            self.image_history_buffer = np.append(self.image_history_buffer, image_batch[:images_to_add], axis=0)
+        if self.num_images < self.max_buffer_size:
+            images_to_add = min(images_to_add, self.max_buffer_size - self.num_images)
+            indices = tf.range(self.num_images, self.num_images + images_to_add)
+            self.num_images += images_to_add
         else:
-            self.image_history_buffer[:images_to_add] = image_batch[:images_to_add]
+            indices = tf.random_uniform([images_to_add], minval=0, maxval=self.max_buffer_size, dtype=tf.int32)
 
-        np.random.shuffle(self.image_history_buffer)
+        tf.scatter_update(self.image_history_buffer, indices, image_batch[:images_to_add])
 
     def _get_from_image_history_buffer(self):
-        """Private method to get random images from buffer. The randomness is
-            achieved with the shuffle in the _add_to method, since _add_to and
-            _get_from are always called consecutively.
+        """Private method to get max(1, batch size / 2) random images from the
+            filled part of the buffer.
         """
         images_to_get = max(1, self.batch_size // 2)
-        return self.image_history_buffer[:images_to_get]
+        indices = tf.random_uniform([images_to_get], minval=0, maxval=self.num_images, dtype=tf.int32)
+        return tf.gather(self.image_history_buffer, indices)
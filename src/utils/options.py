@@ -19,13 +19,16 @@ class Options(object):
         parser.add_argument('--instance_norm', action='store_false', help='if true, uses instance normalisation after each conv layer in D and G')
         parser.add_argument('--init_scale', type=float, default=0.02, help='stddev for weight initialisation; small variance helps prevent colour inversion.')
         parser.add_argument('--gen_skip', action='store_true', help='if true, use skip connection from first residual block to last in generator')
-        parser.add_argument('--resize_conv', action='store_false', help='if true, replace conv2dtranspose in generator with upsample -> conv2d')
+        parser.add_argument('--resize_conv', action='store_false', help='if true, replace conv2dtranspose in generator with nearest neighbour upsample -> conv2d; on by default as it avoids checkerboard artifacts and is faster on cuDNN, pass this flag to use conv2dtranspose')
         parser.add_argument('--use_dropout', action='store_true', help='if true, use dropout for the generator')
         parser.add_argument('--dropout_prob', type=float, default=0.5, help='dropout probability for all layers in generator')
+        parser.add_argument('--data_format', type=str, default=None, choices=['channels_first', 'channels_last'], help='layout for G and D activations; if unset, channels_first (fastest for float32 cuDNN convs) on GPU, otherwise channels_last (needed on CPU and best for float16 Tensor Cores)')
+        parser.add_argument('--mixed_precision', action='store_true', help='if true, computes G and D in float16 with float32 master weights and dynamic loss scaling. Only worthwhile on GPUs with Tensor Cores')
         # dataset options
         cpu_count = multiprocessing.cpu_count()
-        parser.add_argument('--num_threads', type=int, default=cpu_count, help='number of CPU threads to use for loading data')
+        parser.add_argument('--num_threads', type=int, default=cpu_count, help='number of image files to read and decode concurrently')
         parser.add_argument('--img_size', type=int, default=256, help='input image size')
+        parser.add_argument('--decode_ratio', type=int, default=1, choices=[1, 2, 4, 8], help='downscale JPEGs by this factor while decoding, skipping most of the IDCT work; only use if source images are at least this many times larger than img_size')
         self.parser = parser
 
     def parse(self, training):
@@ -36,6 +39,8 @@ class Options(object):
              self.parser = self._get_test_options(self.parser)
 
         opt = self.parser.parse_args()
+        if opt.data_format is None:
+            opt.data_format = 'channels_first' if opt.gpu_id != -1 and not opt.mixed_precision else 'channels_last'
         self.print_options(opt)
         return opt
 
@@ -60,6 +65,9 @@ class Options(object):
         parser.add_argument('--summary_freq', type=int, default=100, help='frequency of saving saving tensorboard summaries in training steps')
         parser.add_argument('--epochs', type=int, default=200, help='number of epochs to train the model; learning rate decays to 0 by epoch 200')
         parser.add_argument('--batch_size', type=int, default=1, help='input batch size')
+        parser.add_argument('--accum_steps', type=int, default=1, help='number of batches to accumulate gradients over before each update; gives an effective batch size of batch_size * accum_steps')
+        parser.add_argument('--use_tfrecords', action='store_true', help='if true, reads pre-resized training images from data_dir/tfrecords, see data/make_tfrecords.py')
+        parser.add_argument('--cache_dir', type=str, default='', help='directory to cache decoded training images in so they persist across runs; if empty, caches in memory')
         parser.add_argument('--lr', type=float, default=0.0002, help='initial learning rate for adam')
         parser.add_argument('--beta1', type=float, default=0.5, help='momentum term for adam')
         parser.add_argument('--niter', type=int, default=100, help='number of epochs at initial learning rate')